@@ -0,0 +1,7 @@
+# gunicorn -c gunicorn.conf.py app:app (run from src/)
+import multiprocessing
+
+bind = "0.0.0.0:8080"
+workers = multiprocessing.cpu_count()
+worker_class = "gevent"
+worker_connections = 1000
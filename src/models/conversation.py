@@ -13,7 +13,9 @@ class Conversation(db.Model):
     customer_contact_id = db.Column(
         db.String(36), db.ForeignKey("customer_contacts.id"), nullable=False
     )
-    participants_key = db.Column(db.String(100), nullable=False, index=True)
+    participants_key = db.Column(
+        db.String(100), nullable=False, index=True, unique=True
+    )
     created_at = db.Column(
         db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc)
     )
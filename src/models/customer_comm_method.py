@@ -25,4 +25,5 @@ class CustomerCommMethod(db.Model):
         db.UniqueConstraint(
             "customer_id", "type", "value", name="uq_customer_comm_type_value"
         ),
+        db.Index("ix_ccm_type_value", "type", "value"),
     )
@@ -20,3 +20,5 @@ class CustomerContact(db.Model):
     customer_contact_comm_method = db.relationship(
         "CustomerContactCommMethod", back_populates="customer_contact", lazy=True
     )
+
+    __table_args__ = (db.Index("ix_cc_customer_id", "customer_id"),)
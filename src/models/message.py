@@ -2,6 +2,8 @@ from . import db
 from datetime import datetime, timezone
 import uuid
 
+from models.message_status import MessageStatus
+
 
 class Message(db.Model):
     __tablename__ = "messages"
@@ -30,6 +32,7 @@ class Message(db.Model):
     message_type = db.Column(db.String(10), nullable=False)
     body = db.Column(db.Text, nullable=True)
     attachments = db.Column(db.Text, nullable=True)  # json string of attachments
+    status = db.Column(db.Enum(MessageStatus), nullable=True)  # outbound only
     timestamp = db.Column(
         db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc)
     )
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class MessageStatus(Enum):
+    pending = "pending"
+    sent = "sent"
+    failed = "failed"
@@ -0,0 +1,37 @@
+from unittest import mock
+import pybreaker
+import pytest
+import requests
+
+from utils import outbound_util
+from utils.outbound_util import OutboundCircuitBreaker
+
+API_URL = "https://www.provider.app/api/messages"
+
+
+def test_send_accepted_while_the_circuit_opens_is_sent():
+    breaker = OutboundCircuitBreaker(fail_max=5, reset_timeout=30)
+
+    def send_message(api_url, message_data):
+        # other sends trip the circuit while this one is in flight
+        breaker.open()
+        return True
+
+    with mock.patch.object(outbound_util, "send_message", side_effect=send_message):
+        assert breaker.send_message(API_URL, {}) is True
+
+    assert breaker.current_state == pybreaker.STATE_OPEN
+
+
+def test_send_that_trips_the_circuit_raises_its_own_error():
+    breaker = OutboundCircuitBreaker(fail_max=1, reset_timeout=30)
+
+    with mock.patch.object(
+        outbound_util,
+        "send_message",
+        side_effect=requests.exceptions.ConnectionError("down"),
+    ):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            breaker.send_message(API_URL, {})
+
+    assert breaker.current_state == pybreaker.STATE_OPEN
@@ -1,13 +1,68 @@
 from datetime import datetime, timezone
+import atexit
+import collections
+import functools
+import logging
+import queue
+import sqlite3
+import threading
+import time
 import uuid
-from sqlalchemy import text
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 
 from models import db
 from models.contact_type import ContactType
+from models.customer_comm_method import CustomerCommMethod
 from models.customer_contact import CustomerContact
 from models.customer_contact_comm_method import CustomerContactCommMethod
 from models.conversation import Conversation
 from models.message import Message
+from models.message_status import MessageStatus
+
+logger = logging.getLogger("messaging_service")
+
+# message columns the service sets itself, kept when a message row has to be saved
+# without the client supplied values that made its insert fail
+MESSAGE_REFERENCE_COLUMNS = (
+    "id",
+    "conversation_id",
+    "from_customer_comm_id",
+    "to_customer_comm_id",
+    "from_contact_comm_id",
+    "to_contact_comm_id",
+    "message_type",
+    "timestamp",
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Enables WAL mode on new sqlite connections so readers don't block behind writers
+
+    Args:
+        dbapi_connection: the raw dbapi connection
+        connection_record: the pool connection record
+
+    Returns:
+        None
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 
 
 def get_customer_comm_method_id(comm_type: str, value: str) -> tuple[str, str]:
@@ -22,23 +77,21 @@ def get_customer_comm_method_id(comm_type: str, value: str) -> tuple[str, str]:
         tuple containing the customer communication method id and customer id
     """
 
-    comm_type = comm_type.strip().lower()
-    value = value.strip()
+    return _lookup_customer_comm_method(comm_type.strip().lower(), value.strip())
 
-    query = text(
-        """
-        SELECT 
-                id,
-                customer_id
-        FROM customer_comm_methods
-        WHERE type = :comm_type
-        AND value = :value
-    """
+
+@functools.lru_cache(maxsize=8192)
+def _lookup_customer_comm_method(comm_type: str, value: str) -> tuple[str, str]:
+    # customer comm methods rarely change compared to the message rate, so lookups
+    # are cached per process. anything that changes customer_comm_methods must call
+    # _lookup_customer_comm_method.cache_clear(). lookups that raise aren't cached.
+    # select() statements are compiled once and reused from sqlalchemy's cache
+    query = select(CustomerCommMethod.id, CustomerCommMethod.customer_id).where(
+        CustomerCommMethod.type == ContactType(comm_type),
+        CustomerCommMethod.value == value,
     )
 
-    result = db.session.execute(
-        query, {"comm_type": comm_type, "value": value}
-    ).fetchall()
+    result = db.session.execute(query).all()
 
     if not result:
         raise ValueError(f"customer communication method not found for value: {value}")
@@ -47,7 +100,7 @@ def get_customer_comm_method_id(comm_type: str, value: str) -> tuple[str, str]:
             f"multiple customer communication methods found for the same value: {value}"
         )
 
-    return result[0]
+    return tuple(result[0])
 
 
 def get_customer_contact_comm_method_id(
@@ -69,22 +122,22 @@ def get_customer_contact_comm_method_id(
     comm_type = comm_type.strip().lower()
     value = value.strip()
 
-    query = text(
-        """
-        SELECT
-                cm.id,
-                cm.customer_contact_id
-        FROM customer_contact_comm_methods cm
-        INNER JOIN customer_contacts cc ON cc.id = cm.customer_contact_id
-        WHERE cc.customer_id = :customer_id
-        AND cm.type = :comm_type
-        AND cm.value = :value
-    """
+    query = (
+        select(
+            CustomerContactCommMethod.id, CustomerContactCommMethod.customer_contact_id
+        )
+        .join(
+            CustomerContact,
+            CustomerContact.id == CustomerContactCommMethod.customer_contact_id,
+        )
+        .where(
+            CustomerContact.customer_id == customer_id,
+            CustomerContactCommMethod.type == ContactType(comm_type),
+            CustomerContactCommMethod.value == value,
+        )
     )
 
-    result = db.session.execute(
-        query, {"customer_id": customer_id, "comm_type": comm_type, "value": value}
-    ).fetchall()
+    result = db.session.execute(query).all()
 
     if len(result) > 1:
         raise ValueError(
@@ -110,7 +163,8 @@ def get_customer_contact_comm_method_id(
         value=value,
     )
     db.session.add(new_comm)
-    db.session.commit()
+    # flushed only, committed in save_message
+    db.session.flush()
 
     return new_comm.id, new_contact.id
 
@@ -130,18 +184,11 @@ def get_conversation_id(
         string containing the conversation id
     """
 
-    query = text(
-        """
-        SELECT
-                id
-        FROM conversations
-        WHERE participants_key = :participants_key
-    """
+    query = select(Conversation.id).where(
+        Conversation.participants_key == participants_key
     )
 
-    result = db.session.execute(
-        query, {"participants_key": participants_key}
-    ).fetchall()
+    result = db.session.execute(query).all()
 
     if len(result) > 1:
         raise ValueError(
@@ -157,15 +204,185 @@ def get_conversation_id(
         customer_contact_id=customer_contact_id,
         participants_key=participants_key,
     )
-    db.session.add(new_conversation)
-    db.session.commit()
+    # flushed only, committed in save_message. participants_key is unique, so if a
+    # concurrent request created the conversation since the select, only the savepoint
+    # is rolled back and the existing conversation is used
+    try:
+        with db.session.begin_nested():
+            db.session.add(new_conversation)
+    except IntegrityError:
+        return db.session.execute(query).scalar_one()
 
     return new_conversation.id
 
 
+class MessageBatcher:
+    """
+    Buffers message inserts and status updates and writes them on a background thread,
+    one transaction per batch, so the request path doesn't pay a commit (fsync) per
+    message. Writes are applied in the order they were queued. If a batch fails its
+    writes are retried one at a time, so one bad row doesn't drop the whole batch.
+    """
+
+    def __init__(self, max_batch_size: int = 64, max_delay: float = 0.005):
+        """
+        Args:
+            max_batch_size: max number of writes per transaction
+            max_delay: max seconds a write waits in the buffer before being applied
+        """
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.app = None
+        self.thread = None
+        # ids of outbound messages saved as failed after their insert failed, so a
+        # later status update doesn't mark them sent
+        self.failed_ids = collections.OrderedDict()
+        self.max_failed_ids = 1024
+
+    def start(self, app) -> None:
+        """
+        Starts the background write thread
+
+        Args:
+            app: flask app, used for the app context the thread runs in
+
+        Returns:
+            None
+        """
+        self.app = app
+        self.thread = threading.Thread(
+            target=self._run, name="message-batcher", daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Applies any buffered writes and stops the background thread
+
+        Returns:
+            None
+        """
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def enqueue(self, row: dict) -> None:
+        """
+        Adds a message insert to the buffer
+
+        Args:
+            row: dict of message column values
+
+        Returns:
+            None
+        """
+        self.queue.put((True, row))
+
+    def enqueue_update(self, row: dict) -> None:
+        """
+        Adds a message update to the buffer
+
+        Args:
+            row: dict with the message id and the column values to update
+
+        Returns:
+            None
+        """
+        self.queue.put((False, row))
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            items = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_delay
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+
+            self._write(items)
+            if stopping:
+                return
+
+    def _write(self, items: list[tuple[bool, dict]]) -> None:
+        # an update is always queued after the insert of its message, so applying the
+        # batch's inserts before its updates keeps them in order
+        inserts = [row for is_insert, row in items if is_insert]
+        updates = [row for is_insert, row in items if not is_insert]
+        with self.app.app_context():
+            try:
+                self._apply(inserts, updates)
+            except Exception as e:
+                logger.error(
+                    f"failed to save batch of {len(items)} message writes, retrying one at a time: {e}"
+                )
+                self._write_each(inserts, updates)
+
+    def _apply(self, inserts: list[dict], updates: list[dict]) -> None:
+        if self.failed_ids:
+            updates = [row for row in updates if row["id"] not in self.failed_ids]
+        with db.session.begin():
+            if inserts:
+                db.session.bulk_insert_mappings(Message, inserts)
+            if updates:
+                db.session.bulk_update_mappings(Message, updates)
+
+    def _write_each(self, inserts: list[dict], updates: list[dict]) -> None:
+        for row in inserts:
+            try:
+                self._apply([row], [])
+            except Exception as e:
+                logger.error(f"failed to save message {row['id']}: {e}")
+                if row.get("status") is MessageStatus.pending:
+                    self._save_failed(row)
+
+        for row in updates:
+            try:
+                self._apply([], [row])
+            except Exception as e:
+                logger.error(f"failed to update message {row['id']}: {e}")
+
+    def _save_failed(self, row: dict) -> None:
+        # the client was already handed the message id, so the outbound message is
+        # saved as failed with only the values the service set itself
+        failed_row = {key: row[key] for key in MESSAGE_REFERENCE_COLUMNS if key in row}
+        failed_row["status"] = MessageStatus.failed
+        try:
+            self._apply([failed_row], [])
+        except Exception as e:
+            logger.error(f"failed to save message {row['id']} as failed: {e}")
+            return
+
+        self.failed_ids[row["id"]] = True
+        if len(self.failed_ids) > self.max_failed_ids:
+            self.failed_ids.popitem(last=False)
+
+
+message_batcher = MessageBatcher()
+
+
 def save_message(message: Message) -> None:
     """
-    Saves message to the database
+    Queues the message for a batched insert. Commits any contact or conversation rows
+    flushed while resolving the participants first, since the message references them.
+    The message id should already be set so it can be returned before the insert happens.
 
     Args:
         message: Message object to be saved
@@ -173,96 +390,207 @@ def save_message(message: Message) -> None:
     Returns:
         None
     """
-    # insert new Message
-    db.session.add(message)
     db.session.commit()
 
+    row = {
+        column.key: getattr(message, column.key)
+        for column in Message.__table__.columns
+        if getattr(message, column.key) is not None
+    }
+    message_batcher.enqueue(row)
 
-def create_sample_data():
-    # check if sample data already exists
-    existing = db.session.execute(text("SELECT id FROM customers LIMIT 1")).fetchone()
-    if existing:
-        return
 
-    now = datetime.now(timezone.utc)
-    now_naive = now.replace(tzinfo=None)
+def update_message_status(message_id: str, status: MessageStatus) -> None:
+    """
+    Queues a status update for a saved message
 
-    customer1_id = str(uuid.uuid4())
-    db.session.execute(
-        text(
-            f"""
-                INSERT INTO customers (id, name, created_at)
-                VALUES ('{customer1_id}', 'Keystone Carpentry', '{now_naive}')
-            """
-        )
-    )
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_comm_methods (id, customer_id, type, value, label, created_at)
-        VALUES
-        ('{uuid.uuid4()}', '{customer1_id}', 'phone', '+12155550000', 'main phone number', '{now_naive}'),
-        ('{uuid.uuid4()}', '{customer1_id}', 'email', 'info@keystonecarpentry.com', 'main email', '{now_naive}'),
-        ('{uuid.uuid4()}', '{customer1_id}', 'whatsapp', '+12155550000', 'whatsapp number', '{now_naive}')
+    Args:
+        message_id: id of the message
+        status: new message status
+
+    Returns:
+        None
     """
-        )
-    )
-    identity1_id = str(uuid.uuid4())
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_contacts (id, customer_id, first_name, last_name, created_at)
-        VALUES ('{identity1_id}', '{customer1_id}', 'Jane', 'Doe', '{now_naive}')
+    message_batcher.enqueue_update({"id": message_id, "status": status})
+
+
+def add_missing_columns() -> None:
     """
-        )
-    )
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_contact_comm_methods (id, customer_contact_id, type, value, created_at)
-        VALUES 
-        ('{uuid.uuid4()}', '{identity1_id}', 'phone', '+15551230001', '{now_naive}'),
-        ('{uuid.uuid4()}', '{identity1_id}', 'email', 'janed@gmail.com', '{now_naive}')
+    Adds model columns that are missing from existing tables, since db.create_all()
+    only creates tables that don't exist yet. Only works for nullable columns. Every
+    gunicorn worker runs this at startup, so a column another worker added first is
+    skipped.
+
+    Returns:
+        None
     """
-        )
-    )
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+            except Exception:
+                # fresh inspector, the one above caches the columns it read
+                added = {
+                    existing_column["name"]
+                    for existing_column in inspect(db.engine).get_columns(table.name)
+                }
+                if column.name not in added:
+                    raise
+                continue
+            logger.info(f"added column {column.name} to {table.name}")
+
+
+def add_missing_indexes() -> None:
+    """
+    Creates model indexes that are missing from existing tables, since db.create_all()
+    only creates indexes along with new tables. An index that exists but isn't unique
+    when the model's is, is recreated as unique. Every gunicorn worker runs this at
+    startup, so an index another worker created first is skipped.
 
-    customer2_id = str(uuid.uuid4())
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customers (id, name, created_at)
-        VALUES ('{customer2_id}', 'Hydro NYC', '{now_naive}')
+    Returns:
+        None
     """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = _get_index_uniqueness(inspector, table.name)
+        for index in table.indexes:
+            if existing.get(index.name) == bool(index.unique):
+                continue
+
+            try:
+                with db.engine.begin() as connection:
+                    if index.name in existing:
+                        index.drop(connection)
+                    index.create(connection)
+            except Exception:
+                created = _get_index_uniqueness(inspect(db.engine), table.name)
+                if created.get(index.name) != bool(index.unique):
+                    raise
+                continue
+            logger.info(f"created index {index.name} on {table.name}")
+
+
+def _get_index_uniqueness(inspector, table_name: str) -> dict[str, bool]:
+    return {
+        index["name"]: bool(index["unique"])
+        for index in inspector.get_indexes(table_name)
+    }
+
+
+def create_sample_data():
+    with db.session.begin():
+        # check if sample data already exists
+        existing = db.session.execute(
+            text("SELECT id FROM customers LIMIT 1")
+        ).fetchone()
+        if existing:
+            return
+
+        now = datetime.now(timezone.utc)
+        now_naive = now.replace(tzinfo=None)
+
+        customer1_id = str(uuid.uuid4())
+        customer2_id = str(uuid.uuid4())
+        identity1_id = str(uuid.uuid4())
+        identity2_id = str(uuid.uuid4())
+
+        customers = [
+            {"id": customer1_id, "name": "Keystone Carpentry"},
+            {"id": customer2_id, "name": "Hydro NYC"},
+        ]
+        customer_comm_methods = [
+            (customer1_id, "phone", "+12155550000", "main phone number"),
+            (customer1_id, "email", "info@keystonecarpentry.com", "main email"),
+            (customer1_id, "whatsapp", "+12155550000", "whatsapp number"),
+            (customer2_id, "phone", "+12155551111", "main number"),
+            (customer2_id, "email", "info@hydronyc.com", "main email"),
+        ]
+        customer_contacts = [
+            {
+                "id": identity1_id,
+                "customer_id": customer1_id,
+                "first_name": "Jane",
+                "last_name": "Doe",
+            },
+            {
+                "id": identity2_id,
+                "customer_id": customer2_id,
+                "first_name": "John",
+                "last_name": "Doe",
+            },
+        ]
+        customer_contact_comm_methods = [
+            (identity1_id, "phone", "+15551230001"),
+            (identity1_id, "email", "janed@gmail.com"),
+            (identity2_id, "phone", "+15551230002"),
+        ]
+
+        # executemany with bound parameters, each statement is prepared once
+        db.session.execute(
+            text(
+                """
+                INSERT INTO customers (id, name, created_at)
+                VALUES (:id, :name, :created_at)
+            """
+            ),
+            [{**row, "created_at": now_naive} for row in customers],
         )
-    )
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_comm_methods (id, customer_id, type, value, label, created_at)
-        VALUES 
-        ('{uuid.uuid4()}', '{customer2_id}', 'phone', '+12155551111', 'main number', '{now_naive}'),
-        ('{uuid.uuid4()}', '{customer2_id}', 'email', 'info@hydronyc.com', 'main email', '{now_naive}')
-    """
+        db.session.execute(
+            text(
+                """
+                INSERT INTO customer_comm_methods (id, customer_id, type, value, label, created_at)
+                VALUES (:id, :customer_id, :type, :value, :label, :created_at)
+            """
+            ),
+            [
+                {
+                    "id": str(uuid.uuid4()),
+                    "customer_id": customer_id,
+                    "type": comm_type,
+                    "value": value,
+                    "label": label,
+                    "created_at": now_naive,
+                }
+                for customer_id, comm_type, value, label in customer_comm_methods
+            ],
         )
-    )
-    identity2_id = str(uuid.uuid4())
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_contacts (id, customer_id, first_name, last_name, created_at)
-        VALUES ('{identity2_id}', '{customer2_id}', 'John', 'Doe', '{now_naive}')
-    """
+        db.session.execute(
+            text(
+                """
+                INSERT INTO customer_contacts (id, customer_id, first_name, last_name, created_at)
+                VALUES (:id, :customer_id, :first_name, :last_name, :created_at)
+            """
+            ),
+            [{**row, "created_at": now_naive} for row in customer_contacts],
         )
-    )
-    db.session.execute(
-        text(
-            f"""
-        INSERT INTO customer_contact_comm_methods (id, customer_contact_id, type, value, created_at)
-        VALUES 
-        ('{uuid.uuid4()}', '{identity2_id}', 'phone', '+15551230002', '{now_naive}')
-    """
+        db.session.execute(
+            text(
+                """
+                INSERT INTO customer_contact_comm_methods (id, customer_contact_id, type, value, created_at)
+                VALUES (:id, :customer_contact_id, :type, :value, :created_at)
+            """
+            ),
+            [
+                {
+                    "id": str(uuid.uuid4()),
+                    "customer_contact_id": customer_contact_id,
+                    "type": comm_type,
+                    "value": value,
+                    "created_at": now_naive,
+                }
+                for customer_contact_id, comm_type, value in customer_contact_comm_methods
+            ],
         )
-    )
 
-    db.session.commit()
+    _lookup_customer_comm_method.cache_clear()
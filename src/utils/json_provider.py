@@ -0,0 +1,60 @@
+from flask import Response, current_app
+from flask.json.provider import DefaultJSONProvider
+from typing import Any
+import orjson
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask json provider backed by orjson, used by request.get_json() and jsonify()
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        """
+        Serializes obj to a json string
+
+        Args:
+            obj: object to serialize
+            **kwargs: flask dump args, only sort_keys and indent are honored
+
+        Returns:
+            json string
+        """
+        option = orjson.OPT_NAIVE_UTC
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        """
+        Deserializes a json string or bytes
+
+        Args:
+            s: json string or bytes
+            **kwargs: ignored, kept for compatibility with the flask provider interface
+
+        Returns:
+            deserialized object
+        """
+        return orjson.loads(s)
+
+
+def json_response(obj: Any, status: int = 200) -> Response:
+    """
+    Builds a json response directly from orjson bytes, skipping jsonify's str round trip
+
+    Args:
+        obj: object to serialize
+        status: http status code
+
+    Returns:
+        json response
+    """
+    return current_app.response_class(
+        orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC),
+        status=status,
+        mimetype="application/json",
+    )
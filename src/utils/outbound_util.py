@@ -0,0 +1,390 @@
+from datetime import datetime, timedelta, timezone
+import atexit
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+import pybreaker
+import requests
+from gevent.pool import Pool
+
+from models.message_status import MessageStatus
+from utils.db_util import update_message_status
+from utils.util import (
+    MAX_RETRIES,
+    RETRY_BUDGET,
+    is_retryable,
+    retry_delay,
+    send_message,
+)
+
+logger = logging.getLogger("messaging_service")
+
+CIRCUIT_FAIL_MAX = 5  # consecutive failed sends before the circuit opens
+CIRCUIT_RESET_TIMEOUT = 30  # seconds the circuit stays open before a probe send
+CIRCUIT_PROBE_WAIT = 1  # seconds a queued send waits on an in flight probe
+
+_WAKE = object()  # queued to wake the dispatcher when a retry is scheduled
+
+
+class OutboundCircuitBreaker(pybreaker.CircuitBreaker):
+    """
+    Circuit breaker for a single outbound url. Once the reset timeout elapses a single
+    send probes the url, the others fail fast until the probe's outcome is recorded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._probe_lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        """
+        Checks if sends would currently fail fast, i.e. the circuit is open and the
+        reset timeout hasn't elapsed yet, or a probe send is in flight. Once the
+        timeout has elapsed, the next send probes the url.
+
+        Returns:
+            bool, true if sends to the url would fail fast
+        """
+        if self._probe_lock.locked():
+            return True
+        if self.current_state != pybreaker.STATE_OPEN:
+            return False
+
+        opened_at = self._state_storage.opened_at
+        reset_at = opened_at + timedelta(seconds=self.reset_timeout)
+        return datetime.now(timezone.utc) < reset_at
+
+    def retry_in(self) -> float:
+        """
+        Gets how long until a send that failed fast may go through, i.e. the rest of
+        the reset timeout, or a short wait for the in flight probe's outcome
+
+        Returns:
+            seconds until the send should be retried
+        """
+        if self.current_state == pybreaker.STATE_OPEN:
+            opened_at = self._state_storage.opened_at
+            reset_at = opened_at + timedelta(seconds=self.reset_timeout)
+            remaining = (reset_at - datetime.now(timezone.utc)).total_seconds()
+            if remaining > 0:
+                return remaining
+        return CIRCUIT_PROBE_WAIT
+
+    def send_message(self, api_url: str, message_data: dict) -> bool:
+        """
+        Sends a message through the circuit breaker. pybreaker holds its lock for the
+        whole guarded call, which would serialize every send to the url, so the send
+        runs outside the breaker and only its outcome is replayed through it.
+
+        Args:
+            api_url: url to send message
+            message_data: message data payload
+
+        Returns:
+            bool, true if message was sent successfully
+        """
+        if self.is_open():
+            raise pybreaker.CircuitBreakerError(f"circuit open for {api_url}")
+
+        # open past the reset timeout or half open, only one send may probe the url
+        probe = self.current_state != pybreaker.STATE_CLOSED
+        if probe and not self._probe_lock.acquire(blocking=False):
+            raise pybreaker.CircuitBreakerError(f"circuit open for {api_url}")
+
+        try:
+            try:
+                message_sent = send_message(api_url, message_data)
+            except Exception as e:
+                try:
+                    self.call(_reraise, e)
+                except pybreaker.CircuitBreakerError:
+                    # the circuit is open or this failure tripped it, the send's own
+                    # error still says what happened
+                    pass
+                raise
+
+            try:
+                return self.call(lambda: message_sent)
+            except pybreaker.CircuitBreakerError:
+                # other sends opened the circuit while this one was in flight, the
+                # provider still accepted the message
+                return message_sent
+        finally:
+            if probe:
+                self._probe_lock.release()
+
+
+def _reraise(error: Exception):
+    raise error
+
+
+def _is_client_error(error: Exception) -> bool:
+    # the provider rejecting a payload (4xx) says nothing about its health, rate
+    # limiting does
+    response = getattr(error, "response", None)
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code != 429
+    )
+
+
+_circuit_breakers: dict[str, OutboundCircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(outbound_url: str) -> OutboundCircuitBreaker:
+    """
+    Gets the circuit breaker for an outbound url, creating it on first use
+
+    Args:
+        outbound_url: url to send message
+
+    Returns:
+        circuit breaker for the url
+    """
+    breaker = _circuit_breakers.get(outbound_url)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.setdefault(
+                outbound_url,
+                OutboundCircuitBreaker(
+                    fail_max=CIRCUIT_FAIL_MAX,
+                    reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                    exclude=[_is_client_error],
+                    name=outbound_url,
+                ),
+            )
+    return breaker
+
+
+class OutboundWorker:
+    """
+    Sends outbound messages to the provider in the background, so the request doesn't
+    wait on the provider round trip and its retries. Sends wait in a bounded queue and
+    are drained in batches, each send running on its own greenlet, so many sends are in
+    flight at once and a batch takes about as long as its slowest send. A send that
+    fails with a transient error is rescheduled after a backoff delay instead of
+    sleeping on its greenlet, as long as the retry starts within RETRY_BUDGET seconds
+    of the send being queued. The saved message is marked sent or failed once the send
+    completes.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 256,
+        max_queue_size: int = 1024,
+        max_batch_size: int = 64,
+    ):
+        """
+        Args:
+            max_concurrency: max number of sends in flight
+            max_queue_size: max number of sends waiting to be dispatched
+            max_batch_size: max number of sends dispatched per wakeup
+        """
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.pool = Pool(max_concurrency)
+        self.thread = None
+        # heap of (visible_at, sequence, item) for sends waiting to be retried
+        self.retries = []
+        self.retries_lock = threading.Lock()
+        self.retry_sequence = itertools.count()
+
+    def start(self) -> None:
+        """
+        Starts the background dispatch thread
+
+        Returns:
+            None
+        """
+        self.thread = threading.Thread(
+            target=self._run, name="outbound-worker", daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Sends any queued messages and stops the background thread. Messages still
+        waiting for a retry are marked failed.
+
+        Returns:
+            None
+        """
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def is_full(self) -> bool:
+        """
+        Checks if the send queue is full, callers should shed load rather than queue
+
+        Returns:
+            bool, true if the send queue is full
+        """
+        return self.queue.full()
+
+    def enqueue(self, outbound_url: str, data: dict, message_id: str) -> bool:
+        """
+        Queues a message to be sent. Doesn't wait for space so a full queue sheds load
+        instead of parking the request.
+
+        Args:
+            outbound_url: url to send message
+            data: message data payload
+            message_id: id of the saved message
+
+        Returns:
+            bool, false if the send queue is full and the message wasn't queued
+        """
+        try:
+            # monotonic so wall clock adjustments can't stretch or cut the retry budget
+            deadline = time.monotonic() + RETRY_BUDGET
+            self.queue.put_nowait((outbound_url, data, message_id, 1, deadline))
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            try:
+                items = [self.queue.get(timeout=self._next_retry_in())]
+            except queue.Empty:
+                items = []
+            while len(items) < self.max_batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            items.extend(self._pop_due_retries())
+
+            stopping = False
+            for item in items:
+                if item is None:
+                    stopping = True
+                elif item is not _WAKE:
+                    # waits for a free slot once max_concurrency sends are in flight
+                    self.pool.spawn(self._send, *item)
+
+            if stopping:
+                self.pool.join()
+                self._fail_pending_retries()
+                return
+
+    def _send(
+        self,
+        outbound_url: str,
+        data: dict,
+        message_id: str,
+        attempt: int,
+        deadline: float,
+    ) -> None:
+        # every failed attempt counts towards opening the circuit, once open queued
+        # sends wait for it to close instead of reaching the provider
+        breaker = get_circuit_breaker(outbound_url)
+        try:
+            breaker.send_message(outbound_url, data)
+        except pybreaker.CircuitBreakerError:
+            # the send never reached the provider so it doesn't use up an attempt,
+            # jittered so the waiting sends don't all race for the probe
+            delay = breaker.retry_in() * random.uniform(1, 1.5)
+            if time.monotonic() + delay <= deadline:
+                logger.warning(
+                    "circuit open for %s, retrying message %s in %.1fs",
+                    outbound_url,
+                    message_id,
+                    delay,
+                )
+                self._schedule_retry(
+                    (outbound_url, data, message_id, attempt, deadline), delay
+                )
+                return
+
+            logger.error(
+                "message %s failed to send to outbound url %s: circuit open",
+                message_id,
+                outbound_url,
+            )
+            update_message_status(message_id, MessageStatus.failed)
+            return
+        except Exception as e:
+            if is_retryable(e) and attempt < MAX_RETRIES:
+                delay = retry_delay(attempt, e)
+                # e.g. a long Retry-After, fail now rather than hold the message
+                if time.monotonic() + delay <= deadline:
+                    logger.warning(
+                        "%s sending message %s (attempt %s/%s). retrying...",
+                        type(e).__name__,
+                        message_id,
+                        attempt,
+                        MAX_RETRIES,
+                    )
+                    self._schedule_retry(
+                        (outbound_url, data, message_id, attempt + 1, deadline),
+                        delay,
+                    )
+                    return
+
+            if isinstance(e, requests.exceptions.RequestException):
+                logger.error(
+                    "message %s failed to send to outbound url %s: %s",
+                    message_id,
+                    outbound_url,
+                    e,
+                )
+            else:
+                # not a provider error, e.g. an unserializable payload or a bug
+                logger.exception(
+                    "message %s failed to send to outbound url %s",
+                    message_id,
+                    outbound_url,
+                )
+            update_message_status(message_id, MessageStatus.failed)
+            return
+
+        logger.info("message %s sent successfully", message_id)
+        update_message_status(message_id, MessageStatus.sent)
+
+    def _schedule_retry(self, item: tuple, delay: float) -> None:
+        with self.retries_lock:
+            heapq.heappush(
+                self.retries,
+                (time.monotonic() + delay, next(self.retry_sequence), item),
+            )
+        try:
+            self.queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass  # the dispatcher has queued sends to wake up for anyway
+
+    def _next_retry_in(self) -> float | None:
+        with self.retries_lock:
+            if not self.retries:
+                return None
+            return max(0, self.retries[0][0] - time.monotonic())
+
+    def _pop_due_retries(self) -> list[tuple]:
+        due = []
+        now = time.monotonic()
+        with self.retries_lock:
+            while self.retries and self.retries[0][0] <= now:
+                due.append(heapq.heappop(self.retries)[2])
+        return due
+
+    def _fail_pending_retries(self) -> None:
+        with self.retries_lock:
+            pending, self.retries = self.retries, []
+        for _, _, (_, _, message_id, _, _) in pending:
+            logger.error(f"message {message_id} not retried before shutdown")
+            update_message_status(message_id, MessageStatus.failed)
+
+
+outbound_worker = OutboundWorker()
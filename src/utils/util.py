@@ -1,108 +1,287 @@
 from flask import abort
-from typing import Optional, Any, get_origin, get_args
+from typing import Optional, Any, Callable, get_origin, get_args
 from datetime import datetime
+from enum import IntEnum
+import collections
+import functools
 import logging
-import time
-import traceback
+import os
+import random
+import ciso8601
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger("messaging_service")
 
 MAX_RETRIES = 3  # number of retry attempts
 RETRY_DELAY = 5  # initial retry delay in seconds
+RETRY_BUDGET = 60  # max seconds from queueing a send until its last retry starts
+# exponential backoff delay after each failed attempt, jitter is applied per retry
+_BACKOFF = tuple(RETRY_DELAY * (1 << i) for i in range(MAX_RETRIES))
+SEND_TIMEOUT = (3.05, 10)  # connect and read timeouts in seconds
+# transient errors worth retrying, requests raises its own timeout types
+RETRYABLE_ERRORS = (
+    TimeoutError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+VALID_MESSAGE_TYPES = frozenset(("sms", "mms", "email"))
+# fields required for a message type on top of their required flag
+# maybe enforce mms if attachments field is provided
+TYPE_REQUIRED_FIELDS = {"sms": ("body",), "mms": ("attachments",)}
+
+# remembers payloads that passed validation so repeats (test suites, retried requests)
+# skip the checks. off by default since it holds memory, set VALIDATION_CACHE=1 in
+# dev and test
+VALIDATION_CACHE_ENABLED = os.environ.get("VALIDATION_CACHE") == "1"
+VALIDATION_CACHE_SIZE = 1024  # payloads remembered per validator
+
+# shared session so provider connections (tcp + tls) are kept alive and reused,
+# retries are handled by the outbound worker
+_session = requests.Session()
+# pool_maxsize matches the outbound worker concurrency so no connection is discarded
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=256, max_retries=0)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+
+class FieldKind(IntEnum):
+    """
+    How a payload field's value is checked, resolved once per schema
+    """
+
+    PLAIN = 0
+    LIST = 1
+    DATETIME = 2
+
+
+def _resolve_type(expected_type: type) -> tuple[FieldKind, Optional[type]]:
+    # generic types like list[str] are unpacked here so typing isn't walked per request
+    if get_origin(expected_type) is list:
+        return FieldKind.LIST, get_args(expected_type)[0]
+    if expected_type is datetime:
+        return FieldKind.DATETIME, None
+    return FieldKind.PLAIN, None
 
 
-def validate_payload(
-    data: dict,
-    payload_fields: list[dict],
-    one_of_fields: list = None,
-) -> None:
+def compile_schema(payload_fields: list[dict]) -> tuple[tuple, ...]:
     """
-    Validates the incoming payload.
-        - checks if the 'type' field is present and valid (either 'sms','mms', 'email').
-        - checks if the required fields are present and of the correct data type.
+    Compiles payload field definitions into the schema used by compile_validator, so
+    the field dicts are only read and the field types only classified once at import
+    time instead of on every request.
 
     Args:
-        data: json payload
         payload_fields: list of dicts with payload field name, data type, required flag
-        one_of_fields: list of optional fields, at least one of which must be present.
 
     Returns:
-        None
+        tuple of (field name, data type, required flag, field kind, list item type)
+        tuples, the item type is None for fields that aren't lists
+    """
+    return tuple(
+        (item["field"], item["type"], item["required"], *_resolve_type(item["type"]))
+        for item in payload_fields
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def compile_validator(
+    payload_fields: tuple[tuple, ...],
+    one_of_fields: tuple = None,
+) -> Callable[[dict], None]:
     """
-    errors = []
+    Compiles a validator for a payload schema. The schema is only walked here, once per
+    message type with that type's required fields applied, and the returned validator
+    runs the prebuilt checks for the payload's type. Validators are cached per schema.
 
-    message_type = data.get("type")
+    Args:
+        payload_fields: schema compiled by compile_schema
+        one_of_fields: tuple of optional fields, at least one of which must be present.
 
-    if not isinstance(message_type, str):
-        abort(
-            400,
-            description=f"invalid 'type'. 'type' must be a non-empty string",
+    Returns:
+        function that validates a json payload and aborts with 400 if it's invalid
+    """
+    field_checks_by_type = {
+        message_type: tuple(
+            _compile_field_check(*field)
+            for field in _specialize_schema(payload_fields, message_type)
         )
+        for message_type in VALID_MESSAGE_TYPES
+    }
+
+    def validator(data: dict) -> None:
+        errors = None  # only allocated once a field fails
+
+        message_type = data.get("type")
+
+        if not isinstance(message_type, str):
+            abort(
+                400,
+                description=f"invalid 'type'. 'type' must be a non-empty string",
+            )
+
+        if not message_type.islower():
+            message_type = message_type.lower()
+        field_checks = field_checks_by_type.get(message_type)
+        if field_checks is None:
+            abort(
+                400,
+                description=f"unsupported 'type' in payload. supported types are 'sms', 'mms', and 'email'",
+            )
+
+        if message_type == "email":
+            check_one_of_fields(data, one_of_fields)
+
+        # check the payload fields
+        for field_check in field_checks:
+            error = field_check(data)
+            if error is not None:
+                if errors is None:
+                    errors = []
+                errors.append(error)
+
+        if errors is not None:
+            abort(400, description="; ".join(errors))
+
+    if not VALIDATION_CACHE_ENABLED:
+        return validator
+
+    # keyed on the serialized payload itself rather than its hash, so colliding
+    # payloads can't share a result, and kept per validator so a payload valid for
+    # one schema isn't taken as valid for another
+    validated_payloads = collections.OrderedDict()
+
+    def cached_validator(data: dict) -> None:
+        key = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        if key in validated_payloads:
+            validated_payloads.move_to_end(key)
+            return
+
+        validator(data)
+
+        validated_payloads[key] = True
+        if len(validated_payloads) > VALIDATION_CACHE_SIZE:
+            validated_payloads.popitem(last=False)
+
+    return cached_validator
+
+
+def _specialize_schema(
+    payload_fields: tuple[tuple, ...], message_type: str
+) -> tuple[tuple, ...]:
+    """
+    Marks the fields required for a message type as required in the schema
+
+    Args:
+        payload_fields: schema compiled by compile_schema
+        message_type: message type the schema is specialized for
+
+    Returns:
+        schema with the message type's required fields applied
+    """
+    type_required_fields = TYPE_REQUIRED_FIELDS.get(message_type, ())
+    return tuple(
+        (name, expected_type, required or name in type_required_fields, *rest)
+        for name, expected_type, required, *rest in payload_fields
+    )
+
+
+def _compile_field_check(
+    field_name: str,
+    expected_type: type,
+    required_field: bool,
+    kind: FieldKind,
+    item_type: Optional[type],
+) -> Callable[[dict], Optional[str]]:
+    """
+    Builds the check for a single payload field, resolving the expected type once
+
+    Args:
+        field_name: payload field name
+        expected_type: expected data type of the field
+        required_field: required flag
+        kind: field kind from compile_schema
+        item_type: list item type from compile_schema
+
+    Returns:
+        function taking the payload, returning an error message or None
+    """
+    missing_error = f"payload missing required field: {field_name}"
 
-    message_type = message_type.lower()
-    if message_type not in ["sms", "mms", "email"]:
-        abort(
-            400,
-            description=f"unsupported 'type' in payload. supported types are 'sms', 'mms', and 'email'",
+    # handle generic types like list[str]
+    if kind is FieldKind.LIST:
+        type_error = (
+            f"payload field '{field_name}' must be a list of {item_type.__name__}"
         )
 
-    if message_type == "email":
-        check_one_of_fields(data, one_of_fields)
+        item_types = frozenset((item_type,))
+
+        def check_value(value: Any) -> Optional[str]:
+            if not isinstance(value, list):
+                return type_error
+            # one pass collecting the distinct item types, subclasses are only checked
+            # per distinct type rather than per item
+            value_types = {type(x) for x in value}
+            if value_types <= item_types:
+                return None
+            if not all(issubclass(t, item_type) for t in value_types):
+                return type_error
+            return None
+
+    # handle datetime types
+    elif kind is FieldKind.DATETIME:
+        type_error = f"payload field '{field_name}' must be an ISO8601 string representing datetime"
+        format_error = (
+            f"payload field '{field_name}' must be a valid ISO8601 datetime string"
+        )
 
-    # check the payload fields
-    for item in payload_fields:
-        field_name = item["field"]
-        expected_type = item["type"]
-        required_field = item["required"]
-        value = data.get(field_name)
+        def check_value(value: Any) -> Optional[str]:
+            if not isinstance(value, str):
+                return type_error
+            try:
+                parse_iso_datetime(value)
+            except ValueError:
+                return format_error
+            return None
+
+    # handle other types
+    else:
+        type_error = (
+            f"payload field '{field_name}' must be of type {expected_type.__name__}"
+        )
 
-        if message_type == "sms" and field_name == "body":
-            required_field = True
-        elif message_type == "mms" and field_name == "attachments":
-            required_field = True
-        # maybe enforce mms if attachments field is provided
+        def check_value(value: Any) -> Optional[str]:
+            if not isinstance(value, expected_type):
+                return type_error
+            return None
 
+    def field_check(data: dict) -> Optional[str]:
+        value = data.get(field_name)
         if value is None:
             if required_field:
-                errors.append(f"payload missing required field: {field_name}")
-            continue
-
-        # handle generic types like list[str]
-        origin = get_origin(expected_type)
-        if origin is list:
-            item_type = get_args(expected_type)[0]
-            if not isinstance(value, list) or not all(
-                isinstance(x, item_type) for x in value
-            ):
-                errors.append(
-                    f"payload field '{field_name}' must be a list of {item_type.__name__}"
-                )
+                return missing_error
+            return None
+        return check_value(value)
 
-        # handle datetime types
-        elif expected_type is datetime:
-            if not isinstance(value, str):
-                errors.append(
-                    f"payload field '{field_name}' must be an ISO8601 string representing datetime"
-                )
-            else:
-                try:
-                    value = value.replace("Z", "+00:00") if "Z" in value else value
-                    parsed = datetime.fromisoformat(value)
-                except ValueError:
-                    errors.append(
-                        f"payload field '{field_name}' must be a valid ISO8601 datetime string"
-                    )
-
-        # handle other types
-        else:
-            if not isinstance(value, expected_type):
-                errors.append(
-                    f"payload field '{field_name}' must be of type {expected_type.__name__}"
-                )
+    return field_check
 
-    if errors:
-        abort(400, description="; ".join(errors))
+
+@functools.lru_cache(maxsize=4096)
+def parse_iso_datetime(value: str) -> datetime:
+    """
+    Parses an ISO8601 datetime string. Used both to validate and to store timestamps,
+    so any timestamp that passes validation can be saved. Cached since batched sends
+    often share timestamps.
+
+    Args:
+        value: ISO8601 datetime string
+
+    Returns:
+        parsed datetime, raises ValueError if the string isn't a valid datetime
+    """
+    return ciso8601.parse_datetime(value)
 
 
 def check_one_of_fields(data: dict, one_of_fields: list) -> None:
@@ -145,15 +324,18 @@ def send_message(api_url: str, message_data: dict) -> bool:
     """
     message_sent = False
     try:
-        response = requests.post(
+        response = _session.post(
             api_url,
-            json=message_data,
+            data=orjson.dumps(message_data),
             headers={"Content-Type": "application/json"},
+            timeout=SEND_TIMEOUT,
         )
         response.raise_for_status()
 
-        logger.info(f"response status code: {response.status_code}")
-        logger.info(f"response json: {response.text}")
+        logger.info("response status code: %s", response.status_code)
+        # decoding the body is only worth it when it's logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("response json: %s", response.text)
 
         message_sent = True
 
@@ -162,29 +344,44 @@ def send_message(api_url: str, message_data: dict) -> bool:
         raise e
 
 
-def api_retry_with_backoff(func, *args, **kwargs):
+def is_retryable(error: Exception) -> bool:
     """
-    Retries a function call with exponential backoff on timeout errors.
+    Checks if a failed call is worth retrying, i.e. it failed with a transient error or
+    the server rate limited it
+
     Args:
-        func: Function to call
-        *args, **kwargs: Arguments to pass to the function
+        error: error raised by the call
 
     Returns:
-        the function's result if successful, or None if all retries fail.
-    """
-    for attempt in range(1, MAX_RETRIES + 1):
-        try:
-            # try calling the function
-            return func(*args, **kwargs)
-        except TimeoutError as e:
-            logger.warning(
-                f"timeout occurred in {func.__name__} (attempt {attempt}/{MAX_RETRIES}). retrying..."
-            )
+        bool, true if the call should be retried
+    """
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code == 429
+    )
+
+
+def retry_delay(attempt: int, error: Exception = None) -> float:
+    """
+    Gets the delay before retrying a failed attempt. Honors the server's Retry-After
+    header on rate limited calls, otherwise backs off exponentially, jittered so failed
+    calls don't retry in lockstep
 
-            # exponential backoff
-            time.sleep(RETRY_DELAY * (2 ** (attempt - 1)))
-        except Exception as e:
-            error = traceback.format_exc()
-            logger.error(f"unhandled exception in {func.__name__}: {error}")
-            break  # stop retrying on non-timeout errors
-    return False  # return None if all retries fail
+    Args:
+        attempt: number of the failed attempt, starting at 1
+        error: error raised by the failed attempt
+
+    Returns:
+        delay in seconds
+    """
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        # http-date values fall back to the backoff delay
+        if retry_after.isdigit():
+            return float(retry_after)
+
+    return _BACKOFF[attempt - 1] * random.uniform(0.5, 1.5)